@@ -0,0 +1,11 @@
+import numpy as np
+from numba import njit, prange
+
+@njit(parallel=True, fastmath=True, cache=True)
+def normalize_into(img_u8, out_chw, top, left):
+    new_h, new_w = img_u8.shape[0], img_u8.shape[1]
+    scale = np.float32(1.0 / 255.0)
+    for y in prange(new_h):
+        for x in range(new_w):
+            for c in range(3):
+                out_chw[c, top + y, left + x] = img_u8[y, x, c] * scale
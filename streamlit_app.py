@@ -1,60 +1,224 @@
 import streamlit as st
 import numpy as np
 from PIL import Image
+import hashlib
+import importlib.metadata
+import io
 import os
+import threading
+import torch
 from ultralytics import YOLO
-import plotly.express as px
-import pandas as pd
+from ultralytics.utils import ops
+from ultralytics.utils.plotting import colors
 
 try:
     import cv2
 except ImportError:
     cv2 = None
 
+try:
+    from preproc import normalize_into
+except ImportError:
+    normalize_into = None
+
 st.set_page_config(
     page_title="Detector de Danos Veiculares",
     page_icon="🚗",
     layout="wide"
 )
 
+torch.set_float32_matmul_precision('high')
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+INPUT_SIZE = 640
+MAX_BATCH = 16
+MAX_IMAGE_SIDE = 1280
+BOX_COLORS = [colors(i) for i in range(colors.n)]
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+def download_weights(model_url, weights):
+    import urllib.request
+    if not os.path.exists(weights):
+        urllib.request.urlretrieve(model_url, weights + '.part')
+        os.replace(weights + '.part', weights)
+    return weights
+
+def package_version(name):
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return 'none'
+
+def artifact_path(url_key, device_cc, precision, runtime, ext):
+    versions = f"ultralytics{package_version('ultralytics')}-{runtime}{package_version(runtime)}"
+    return f'yolo11m-{url_key}-{device_cc}-{precision}-{versions}.{ext}'
+
+def prepare_model(weights, use_half):
+    model = YOLO(weights, task='detect')
+    model.model_id = weights
+    model.use_half = use_half
+    model.max_batch = 1 if weights.endswith('.engine') else MAX_BATCH
+    model.channels_last = torch.cuda.is_available() and isinstance(model.model, torch.nn.Module)
+    model.pretty_names = None
+    warmup_img = np.zeros((INPUT_SIZE, INPUT_SIZE, 3), dtype=np.uint8)
+    process_image(warmup_img, model)
+    if model.channels_last:
+        model.predictor.model.to(memory_format=torch.channels_last)
+        process_image(warmup_img, model)
+    return model
+
 @st.cache_resource
 def load_model():
     try:
-        import urllib.request
         model_url = "https://github.com/ultralytics/assets/releases/download/v8.3.0/yolo11m.pt"
-        if not os.path.exists('yolo11m.pt'):
-            urllib.request.urlretrieve(model_url, 'yolo11m.pt')
-        model = YOLO('yolo11m.pt')
-        return model
+        url_key = hashlib.sha256(model_url.encode()).hexdigest()[:12]
+        weights = f'yolo11m-{url_key}.pt'
+        use_half = torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 7
+        if torch.cuda.is_available():
+            device_cc = 'sm{}{}'.format(*torch.cuda.get_device_capability())
+            precision = 'fp16' if use_half else 'fp32'
+            try:
+                cached_artifact = artifact_path(url_key, device_cc, precision, 'tensorrt', 'engine')
+                if os.path.exists(cached_artifact):
+                    artifact = cached_artifact
+                else:
+                    exported = YOLO(download_weights(model_url, weights)).export(format='engine', half=use_half, imgsz=INPUT_SIZE, device=0, dynamic=False, batch=1, workspace=4)
+                    # export may pip-install the runtime, so its version is only final now
+                    artifact = artifact_path(url_key, device_cc, precision, 'tensorrt', 'engine')
+                    os.replace(exported, artifact)
+                return prepare_model(artifact, use_half)
+            except Exception as e:
+                st.warning(f"Falha ao carregar o modelo TensorRT, usando PyTorch: {str(e)}")
+        else:
+            try:
+                cached_artifact = artifact_path(url_key, 'cpu', 'fp32', 'onnxruntime', 'onnx')
+                if os.path.exists(cached_artifact):
+                    artifact = cached_artifact
+                else:
+                    exported = YOLO(download_weights(model_url, weights)).export(format='onnx', imgsz=INPUT_SIZE, simplify=True, opset=17, dynamic=True)
+                    # export may pip-install the runtime, so its version is only final now
+                    artifact = artifact_path(url_key, 'cpu', 'fp32', 'onnxruntime', 'onnx')
+                    os.replace(exported, artifact)
+                return prepare_model(artifact, use_half)
+            except Exception as e:
+                st.warning(f"Falha ao carregar o modelo ONNX, usando PyTorch: {str(e)}")
+        return prepare_model(download_weights(model_url, weights), use_half)
     except Exception as e:
         st.error(f"Erro ao carregar o modelo: {str(e)}")
         return None
 
-def process_image(image, model):
-    img_array = np.array(image)
-    results = model(img_array)
+@st.cache_resource
+def get_input_buffers():
+    host_buf = np.empty((3, INPUT_SIZE, INPUT_SIZE), dtype=np.float32)
+    input_tensor = torch.empty((MAX_BATCH, 3, INPUT_SIZE, INPUT_SIZE), dtype=torch.float16, pin_memory=torch.cuda.is_available())
+    return host_buf, input_tensor, threading.Lock()
+
+def limit_size(img_array, max_side=MAX_IMAGE_SIDE):
+    h, w = img_array.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1:
+        return img_array, 1.0
+    new_h, new_w = round(h * scale), round(w * scale)
+    if cv2 is not None:
+        return cv2.resize(img_array, (new_w, new_h), interpolation=cv2.INTER_AREA), scale
+    return np.asarray(Image.fromarray(img_array).resize((new_w, new_h), Image.BILINEAR)), scale
+
+def letterbox(img_array, size=INPUT_SIZE):
+    h, w = img_array.shape[:2]
+    ratio = min(size / h, size / w)
+    new_h, new_w = round(h * ratio), round(w * ratio)
+    if cv2 is not None:
+        resized = cv2.resize(img_array, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    else:
+        resized = np.asarray(Image.fromarray(img_array).resize((new_w, new_h), Image.BILINEAR))
+    top, left = (size - new_h) // 2, (size - new_w) // 2
+    return resized, ratio, top, left
+
+def preprocess(img_array, host_buf, out):
+    resized, ratio, top, left = letterbox(img_array)
+    new_h, new_w = resized.shape[:2]
+    bottom, right = top + new_h, left + new_w
+    out[:, :top].fill_(114 / 255)
+    out[:, bottom:].fill_(114 / 255)
+    out[:, top:bottom, :left].fill_(114 / 255)
+    out[:, top:bottom, right:].fill_(114 / 255)
+    if normalize_into is not None:
+        normalize_into(resized, host_buf, top, left)
+        out[:, top:bottom, left:right].copy_(torch.from_numpy(host_buf[:, top:bottom, left:right]))
+    else:
+        np.multiply(resized.transpose(2, 0, 1), 1 / 255, out=out.numpy()[:, top:bottom, left:right])
+    return (ratio, ratio), (left, top)
+
+def draw_boxes(img_array, xyxy_arr, cls_arr, conf_arr, names, pretty_names):
+    annotated_img = img_array.copy()
+    if cv2 is None:
+        return annotated_img
+    for (x1, y1, x2, y2), c, p in zip(xyxy_arr.astype(int), cls_arr, conf_arr):
+        color = BOX_COLORS[c % len(BOX_COLORS)]
+        cv2.rectangle(annotated_img, (x1, y1), (x2, y2), color, 2)
+        label = f"{pretty_names[names[c]]} {p:.0%}"
+        (text_w, text_h), baseline = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+        label_y = max(y1, text_h + baseline)
+        cv2.rectangle(annotated_img, (x1, label_y - text_h - baseline), (x1 + text_w, label_y), color, -1)
+        cv2.putText(annotated_img, label, (x1, label_y - baseline), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+    return annotated_img
+
+def postprocess(result, img_array, input_shape, ratio_pad, scale, pretty_names):
+    data = result.boxes.data.clone()
+    xyxy = ops.scale_boxes(input_shape, data[:, :4], img_array.shape, ratio_pad=ratio_pad)
+    ops.clip_boxes(xyxy, img_array.shape)
     
-    detections = []
-    if len(results[0].boxes) > 0:
-        boxes = results[0].boxes
-        for i in range(len(boxes)):
-            detection = {
-                'class': results[0].names[int(boxes.cls[i])],
-                'confidence': float(boxes.conf[i]),
-                'bbox': boxes.xyxy[i].cpu().numpy()
-            }
-            detections.append(detection)
+    cls_arr = data[:, 5].cpu().numpy().astype(int)
+    conf_arr = data[:, 4].cpu().numpy()
+    xyxy_arr = xyxy.cpu().numpy()
+    names = result.names
+    detections = [
+        {'class': names[c], 'confidence': float(p), 'bbox': xyxy_arr[i] / scale}
+        for i, (c, p) in enumerate(zip(cls_arr, conf_arr))
+    ]
     
-    try:
-        annotated_img = results[0].plot()
-        if cv2 is not None:
-            annotated_img = cv2.cvtColor(annotated_img, cv2.COLOR_BGR2RGB)
-    except:
-        annotated_img = img_array
+    annotated_img = draw_boxes(img_array, xyxy_arr, cls_arr, conf_arr, names, pretty_names)
     
     return detections, annotated_img
 
-def create_detection_summary(detections):
+def decode_image(img_bytes):
+    if cv2 is not None:
+        bgr = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if bgr is not None:
+            return bgr[..., ::-1]
+    return np.array(Image.open(io.BytesIO(img_bytes)).convert('RGB'))
+
+def process_images(img_arrays, model):
+    img_arrays, scales = zip(*[limit_size(img_array) for img_array in img_arrays])
+    host_buf, input_tensor, lock = get_input_buffers()
+    outputs = []
+    for start in range(0, len(img_arrays), model.max_batch):
+        chunk = img_arrays[start:start + model.max_batch]
+        chunk_scales = scales[start:start + model.max_batch]
+        with lock:
+            ratio_pads = [preprocess(img_array, host_buf, input_tensor[i]) for i, img_array in enumerate(chunk)]
+            batch = input_tensor[:len(chunk)].to(DEVICE, non_blocking=True)
+            if model.channels_last:
+                batch = batch.contiguous(memory_format=torch.channels_last)
+            with torch.inference_mode(), torch.autocast('cuda', dtype=torch.float16, enabled=model.channels_last and model.use_half):
+                results = model.predict(batch, imgsz=INPUT_SIZE, half=model.use_half, verbose=False)
+        if model.pretty_names is None:
+            model.pretty_names = {name: name.replace('_', ' ').title() for name in results[0].names.values()}
+        with torch.inference_mode():
+            for result, img_array, ratio_pad, scale in zip(results, chunk, ratio_pads, chunk_scales):
+                outputs.append(postprocess(result, img_array, batch.shape[2:], ratio_pad, scale, model.pretty_names))
+    return outputs
+
+def process_image(img_array, model):
+    return process_images([img_array], model)[0]
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_infer(img_bytes, model_id, _model):
+    return process_image(decode_image(img_bytes), _model)
+
+def create_detection_summary(detections, pretty_names):
     if not detections:
         return "Nenhum dano detectado na imagem."
     
@@ -73,35 +237,39 @@ def create_detection_summary(detections):
     for damage_type, confidences in damage_counts.items():
         count = len(confidences)
         avg_confidence = np.mean(confidences)
-        summary.append(f"• **{damage_type.replace('_', ' ').title()}**: {count} ocorrência(s) - Confiança média: {avg_confidence:.1%}")
+        summary.append(f"• **{pretty_names[damage_type]}**: {count} ocorrência(s) - Confiança média: {avg_confidence:.1%}")
     
     return "\n".join(summary)
 
-def create_confidence_chart(detections):
+def create_confidence_chart(detections, pretty_names):
     if not detections:
         return None
     
-    df = pd.DataFrame(detections)
-    df['class_clean'] = df['class'].str.replace('_', ' ').str.title()
+    import plotly.express as px
+    import plotly.graph_objects as go
+    import plotly.io as pio
     
-    fig = px.bar(
-        df, 
-        x='class_clean', 
-        y='confidence',
-        title='Confiança das Detecções por Tipo de Dano',
-        labels={'confidence': 'Confiança (%)', 'class_clean': 'Tipo de Dano'},
-        color='confidence',
-        color_continuous_scale='RdYlGn'
-    )
+    if "damage" not in pio.templates:
+        pio.templates["damage"] = go.layout.Template(
+            layout=go.Layout(
+                xaxis=dict(tickangle=-45),
+                yaxis=dict(tickformat='.0%'),
+                height=400,
+                showlegend=False
+            )
+        )
     
-    fig.update_layout(
-        xaxis_tickangle=-45,
-        height=400,
-        showlegend=False
-    )
+    x = [pretty_names[d['class']] for d in detections]
+    y = [d['confidence'] for d in detections]
     
-    fig.update_layout(
-    yaxis=dict(tickformat='.0%')
+    fig = px.bar(
+        x=x, 
+        y=y,
+        title='Confiança das Detecções por Tipo de Dano',
+        labels={'y': 'Confiança (%)', 'x': 'Tipo de Dano', 'color': 'Confiança (%)'},
+        color=y,
+        color_continuous_scale='RdYlGn',
+        template=pio.templates.default + '+damage'
     )
     
     return fig
@@ -151,13 +319,13 @@ def main():
     st.header("Ou teste com exemplos:")
     
     example_images = {
-        "examples/1.png": "Dent - Amassado",
-        "examples/2.png": "Múltiplos Danos", 
-        "examples/3.png": "Vidro Estilhaçado",
-        "examples/4.png": "Lâmpada Quebrada",
-        "examples/5.png": "Dent - Lateral",
-        "examples/6.png": "Riscos",
-        "examples/7.png": "Múltiplos Riscos"
+        "exemples/1.png": "Dent - Amassado",
+        "exemples/2.png": "Múltiplos Danos", 
+        "exemples/3.png": "Vidro Estilhaçado",
+        "exemples/4.png": "Lâmpada Quebrada",
+        "exemples/5.png": "Dent - Lateral",
+        "exemples/6.png": "Riscos",
+        "exemples/7.png": "Múltiplos Riscos"
     }
     
     col1, col2, col3 = st.columns(3)
@@ -168,13 +336,28 @@ def main():
             if st.button(label, key=f"example_{i}"):
                 try:
                     if os.path.exists(img_path):
-                        example_image = Image.open(img_path)
-                        st.session_state['uploaded_example'] = example_image
+                        with open(img_path, 'rb') as f:
+                            st.session_state['uploaded_example'] = f.read()
                         st.session_state['example_name'] = label
                         st.rerun()
                 except:
                     st.error(f"Exemplo não encontrado: {img_path}")
     
+    if st.button("Analisar todos os exemplos"):
+        available = [(img_path, label) for img_path, label in example_images.items() if os.path.exists(img_path)]
+        if available:
+            with st.spinner("Analisando exemplos..."):
+                img_arrays = []
+                for img_path, _ in available:
+                    with open(img_path, 'rb') as f:
+                        img_arrays.append(decode_image(f.read()))
+                batch_results = process_images(img_arrays, model)
+            for i, ((_, label), (detections, annotated_img)) in enumerate(zip(available, batch_results)):
+                with cols[i % 3]:
+                    st.image(annotated_img, caption=f"{label} - {len(detections)} dano(s)", use_column_width=True)
+        else:
+            st.error("Nenhum exemplo encontrado.")
+    
     image_source = None
     image_name = None
     
@@ -183,7 +366,7 @@ def main():
         image_name = st.session_state['example_name']
         st.info(f"Usando exemplo: {image_name}")
     elif uploaded_file is not None:
-        image_source = Image.open(uploaded_file)
+        image_source = uploaded_file.getvalue()
         image_name = "Imagem enviada"
     
     if image_source is not None:
@@ -194,7 +377,7 @@ def main():
             st.image(image_source, caption=image_name, use_column_width=True)
         
         with st.spinner("Analisando imagem..."):
-            detections, annotated_img = process_image(image_source, model)
+            detections, annotated_img = cached_infer(image_source, model.model_id, model)
         
         with col2:
             st.subheader("Detecções Encontradas")
@@ -205,13 +388,13 @@ def main():
         
         with col1:
             st.markdown("### Detalhes dos Danos")
-            summary = create_detection_summary(detections)
+            summary = create_detection_summary(detections, model.pretty_names)
             st.markdown(summary)
         
         with col2:
             st.markdown("### Gráfico de Confiança")
             if detections:
-                chart = create_confidence_chart(detections)
+                chart = create_confidence_chart(detections, model.pretty_names)
                 if chart:
                     st.plotly_chart(chart, use_container_width=True)
             else:
@@ -219,27 +402,29 @@ def main():
         
         if detections:
             st.header("Detalhes Técnicos")
-            df_detections = pd.DataFrame(detections)
-            df_detections['confidence'] = df_detections['confidence'].apply(lambda x: f"{x:.1%}")
-            df_detections['class'] = df_detections['class'].str.replace('_', ' ').str.title()
-            df_detections = df_detections[['class', 'confidence']].rename(columns={
-                'class': 'Tipo de Dano',
-                'confidence': 'Confiança'
-            })
-            st.dataframe(df_detections, use_container_width=True)
+            rows = [
+                {'Tipo de Dano': model.pretty_names[d['class']], 'Confiança': f"{d['confidence']:.1%}"}
+                for d in detections
+            ]
+            st.dataframe(rows, use_container_width=True)
         
         if detections:
             st.header("Recomendações")
-            if any(d['class'] == 'shattered_glass' for d in detections):
+            classes = set()
+            high_conf = 0
+            for d in detections:
+                classes.add(d['class'])
+                high_conf += d['confidence'] > 0.8
+            
+            if 'shattered_glass' in classes:
                 st.warning("**Vidro quebrado detectado** - Reparo urgente necessário por questões de segurança.")
-            if any(d['class'] == 'flat_tire' for d in detections):
+            if 'flat_tire' in classes:
                 st.warning("**Pneu vazio detectado** - Verifique o pneu antes de dirigir.")
-            if any(d['class'] == 'broken_lamp' for d in detections):
+            if 'broken_lamp' in classes:
                 st.info("**Lâmpada quebrada** - Substitua para manter a segurança no trânsito.")
             
-            high_conf_damages = [d for d in detections if d['confidence'] > 0.8]
-            if high_conf_damages:
-                st.success(f"{len(high_conf_damages)} dano(s) detectado(s) com alta confiança.")
+            if high_conf:
+                st.success(f"{high_conf} dano(s) detectado(s) com alta confiança.")
         
         if st.button("Testar Nova Imagem"):
             if 'uploaded_example' in st.session_state: